@@ -3,16 +3,339 @@ AI Assistant for Online Voting System
 Using LangChain for advanced conversational AI capabilities
 """
 
+import asyncio
+import concurrent.futures
+import hashlib
 import os
-from typing import Dict, List, Optional
-from langchain.chat_models import ChatOpenAI
+import textwrap
+import threading
+import ahocorasick
+import httpx
+from typing import Callable, Dict, List, Optional, Tuple
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
+from gevent import monkey
+from gevent.threadpool import ThreadPoolExecutor
+from langchain.callbacks.base import AsyncCallbackHandler
+from langchain_openai import ChatOpenAI
 from langchain.prompts import ChatPromptTemplate, SystemMessagePromptTemplate, HumanMessagePromptTemplate
 from langchain.schema import HumanMessage, SystemMessage
-from langchain.memory import ConversationBufferMemory
+from langchain.memory import ConversationSummaryBufferMemory
 from langchain.chains import ConversationChain
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.vectorstores import Chroma
-from langchain.text_splitter import CharacterTextSplitter
+from langchain_community.embeddings import HuggingFaceEmbeddings
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+
+KNOWLEDGE_DIR = "./faiss_voting"
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+KNOWLEDGE_FINGERPRINT_FILE = os.path.join(KNOWLEDGE_DIR, "fingerprint.txt")
+
+# Native threads for query embeddings, which are CPU-bound and would otherwise stall the gevent hub
+EMBEDDING_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
+# Pooled keep-alive connections shared by every OpenAI call, so TLS is negotiated once
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32)
+HTTP_CLIENT = httpx.Client(http2=True, limits=HTTP_LIMITS)
+HTTP_ASYNC_CLIENT = httpx.AsyncClient(http2=True, limits=HTTP_LIMITS)
+
+BASE_PROMPT = """You are an AI Assistant for an Online Voting System called NeuroVote. Your role is to help users with:
+
+🎯 Voting Assistant: Help with registration, login, and vote-casting
+💬 FAQ Responder: Answer common questions about the voting process
+🧠 Interactive Help: Provide step-by-step guidance
+🛡️ Security Advisor: Explain security features and privacy
+📈 Election Summary: Provide election information and statistics
+🗣️ General Conversation: Be friendly and conversational, not just functional
+👨‍💼 Admin Support: Provide special assistance for administrators
+
+IMPORTANT GUIDELINES:
+- Be friendly, warm, and conversational - not just robotic
+- Use emojis and clear formatting to make responses engaging
+- If someone asks about non-voting topics, be helpful but gently guide them back to voting-related assistance
+- For admins, provide more detailed technical and administrative support
+- Keep responses concise but comprehensive
+- Always maintain a helpful and positive tone
+- If you don't understand something, ask for clarification or redirect to voting topics
+- Be patient and understanding with users"""
+
+VOTING_KNOWLEDGE = textwrap.dedent("""
+        Online Voting System Features:
+        1. User Registration: Users can register with email, username, and password
+        2. Secure Authentication: Advanced encryption and secure login
+        3. Election Management: Admins can create and manage elections
+        4. Candidate Management: Add and manage election candidates
+        5. Real-time Voting: Live vote casting with immediate updates
+        6. Result Tracking: Real-time election results and statistics
+        7. Security Features: Encrypted votes, anonymous voting, audit trails
+        8. Admin Dashboard: Comprehensive admin interface for system management
+        
+        Voting Process:
+        1. User registers/logs in
+        2. Browse active elections
+        3. Select an election
+        4. View candidates and descriptions
+        5. Cast vote for preferred candidate
+        6. Confirm vote (cannot be changed)
+        7. View real-time results
+        
+        Security Measures:
+        - Advanced encryption for all votes
+        - Anonymous voting (no personal data linked to votes)
+        - Blockchain-like verification
+        - Audit trails for transparency
+        - No vote modification after submission
+        - Secure authentication and session management
+        
+        Common Questions:
+        - How to register: Click Register button, enter email and create password
+        - How to vote: Login, browse elections, select candidate, confirm vote
+        - Can I change my vote: No, votes cannot be modified after submission
+        - Is voting secure: Yes, uses advanced encryption and anonymous voting
+        - How long do elections last: Varies from 24 hours to 10 days
+        - Can I see results: Yes, real-time results are available on election pages
+        """).strip()
+
+# One retrievable chunk per section, so a search returns only the sections a question is about
+KNOWLEDGE_SECTIONS = VOTING_KNOWLEDGE.split("\n\n")
+
+# Fallback replies in priority order: the first group with a matching keyword is used
+FALLBACK_RESPONSES = [
+    # Voting Assistant responses
+    (["register", "sign up", "create account"],
+     "To register: 1) Click 'Register' in top navigation 2) Enter email 3) Create username/password 4) Verify email 5) Start voting! Need help with any step?"),
+    (["vote", "cast vote", "election"],
+     "Voting Process: 1) Login 2) Browse active elections 3) Select election 4) View candidates 5) Click 'Vote for [Candidate]' 6) Confirm choice. Your vote is encrypted and secure!"),
+    (["login", "sign in"],
+     "To login: 1) Click 'Login' 2) Enter username/email 3) Enter password 4) Click 'Login'. Forgot password? Contact support."),
+    
+    # FAQ responses
+    (["change vote", "modify vote"],
+     "Votes cannot be changed once submitted to maintain election integrity. Please review carefully before confirming."),
+    (["how long", "duration", "time"],
+     "Election duration varies: Student Council (7-10 days), Department polls (3-5 days), Quick surveys (24-48 hours)."),
+    
+    # Security responses
+    (["secur", "saf", "privac", "encryption"],
+     "Security Features: 🔐 Advanced encryption, 🔒 Anonymous voting, 🛡️ Blockchain verification, 🔍 Audit trails, 🚫 No vote modification. Your vote is completely secure!"),
+    
+    # Help responses
+    (["help", "support", "assist", "hlp"],
+     "I'm your AI voting assistant! I can help with: Registration, Voting process, Security, Election info, Technical support. What do you need help with?"),
+    
+    # General greetings and casual conversation
+    (["hello", "hi", "hey", "good morning", "good afternoon", "good evening", "how are you"],
+     "Hello! 👋 I'm your AI assistant for NeuroVote. How can I help you today? I can assist with voting, registration, or just chat about anything!"),
+    
+    # Thank you responses
+    (["thank you", "thanks", "appreciate", "grateful"],
+     "You're very welcome! 😊 I'm happy to help. Is there anything else you'd like to know about voting or the system?"),
+    
+    # Questions about the AI itself
+    (["who are you", "what are you", "your name", "ai", "artificial intelligence", "bot"],
+     "I'm an AI assistant designed specifically for NeuroVote! 🤖 I help users with voting, registration, security questions, and general support. I'm here to make your voting experience smooth and enjoyable."),
+]
+
+# Default response - more conversational
+DEFAULT_FALLBACK_RESPONSE = "That's interesting! 🤔 I'm primarily here to help with voting, but I'm happy to chat. Is there anything about the voting system you'd like to know, or do you have other questions?"
+
+def _build_keyword_automaton() -> ahocorasick.Automaton:
+    """Compile every fallback keyword into one Aho-Corasick automaton mapping to its group"""
+    automaton = ahocorasick.Automaton()
+    for rank, (keywords, _) in enumerate(FALLBACK_RESPONSES):
+        for keyword in keywords:
+            if keyword not in automaton:
+                automaton.add_word(keyword, rank)
+    automaton.make_automaton()
+    return automaton
+
+FALLBACK_KEYWORDS = _build_keyword_automaton()
+
+def _knowledge_fingerprint() -> str:
+    """Hash of everything the saved index depends on, so edits trigger a rebuild"""
+    return hashlib.sha256("\0".join([EMBEDDING_MODEL, *KNOWLEDGE_SECTIONS]).encode()).hexdigest()
+
+def _copy_result(source, future: asyncio.Future):
+    """Settle an asyncio future from a finished gevent threadpool future (runs on the loop)"""
+    if future.cancelled():
+        return
+    if source.exception() is not None:
+        future.set_exception(source.exception())
+    else:
+        future.set_result(source.result())
+
+def _format_context(context: Dict) -> str:
+    """Render context as a bullet list appended to the system prompt"""
+    return "\n\nCurrent Context:\n" + "".join(f"- {key}: {value}\n" for key, value in context.items())
+
+class AsyncStreamHandler(AsyncCallbackHandler):
+    """Forward generated tokens to a single Socket.IO client as they arrive"""
+
+    def __init__(self, emit: Callable, sid: str):
+        """
+        Args:
+            emit: Socket.IO emit function (e.g. socketio.emit)
+            sid: Session id of the client that asked the question
+        """
+        self.emit = emit
+        self.sid = sid
+        self.tokens = []
+
+    async def on_llm_new_token(self, token: str, **kwargs) -> None:
+        # The final chunk of a stream carries an empty token
+        if not token:
+            return
+        self.tokens.append(token)
+        self.emit('ai_token', {'t': token}, to=self.sid)
+
+class PromptBatcher:
+    """Group prompts arriving close together into one rate-limited agenerate call
+    
+    LangChain still sends one API request per prompt in a batch, so this throttles
+    and bounds concurrent calls rather than saving round-trips.
+    """
+
+    def __init__(self, llm, max_batch: int = 8, max_delay_ms: int = 50, rpm: int = 100,
+                 timeout: float = 60):
+        """
+        Args:
+            llm: LangChain chat model used to generate the batched replies
+            max_batch: Maximum number of prompts sent in one batch
+            max_delay_ms: How long to wait for more prompts before sending a batch
+            rpm: Maximum number of prompts sent to the API per minute
+            timeout: Seconds a prompt or stream waits for its reply before giving up
+        """
+        self.llm = llm
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self.limiter = AsyncLimiter(rpm, 60)
+        self.timeout = timeout
+        self.queue = None
+        
+        # The loop only keeps weak references to tasks, so hold on to them until done
+        self._tasks = set()
+        
+        # The batcher owns an event loop so sync Flask handlers can share it
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        threading.Thread(target=self._run_loop, args=(ready,), daemon=True).start()
+        ready.wait()
+    
+    def _run_loop(self, ready: threading.Event):
+        asyncio.set_event_loop(self.loop)
+        self.queue = asyncio.Queue()
+        self._track(self.loop.create_task(self._drain()))
+        ready.set()
+        self.loop.run_forever()
+    
+    async def submit(self, messages: List) -> str:
+        """Queue a message list and wait for its reply (must run on self.loop)"""
+        future = self.loop.create_future()
+        await self.queue.put((messages, future))
+        return await future
+    
+    def submit_sync(self, messages: List) -> str:
+        """Queue a message list from a regular thread and block until its reply"""
+        future = asyncio.run_coroutine_threadsafe(self.submit(messages), self.loop)
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+    
+    def _track(self, task: asyncio.Task):
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _drain(self):
+        while True:
+            batch = [await self.queue.get()]
+            deadline = self.loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self._track(self.loop.create_task(self._generate(batch)))
+    
+    async def _generate(self, batch: List):
+        try:
+            # Throttle up front rather than waiting for the API to return 429s
+            for _ in batch:
+                await self.limiter.acquire()
+            result = await self.llm.agenerate([messages for messages, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        for (_, future), generation in zip(batch, result.generations):
+            if not future.done():
+                future.set_result(generation[0].text)
+
+class ConversationSession:
+    """Summary-buffer memory for one client's conversation, guarded by its own lock"""
+
+    def __init__(self, llm, max_token_limit: int = 800):
+        # Keep recent turns verbatim and summarise older ones
+        self.memory = ConversationSummaryBufferMemory(
+            llm=llm,
+            max_token_limit=max_token_limit,
+            return_messages=True
+        )
+        self.lock = threading.Lock()
+        self.compressing = False
+    
+    def history(self) -> List:
+        """Summary of older turns plus the most recent turns verbatim"""
+        with self.lock:
+            return list(self.memory.load_memory_variables({})['history'])
+    
+    def add_turn(self, user_message: str, response: str) -> bool:
+        """Store a turn; returns True if the caller should start compressing"""
+        with self.lock:
+            # save_context would summarise inline, so add the turn and prune separately
+            self.memory.chat_memory.add_user_message(user_message)
+            self.memory.chat_memory.add_ai_message(response)
+            if self.compressing or not self._excess_messages():
+                return False
+            self.compressing = True
+            return True
+    
+    def compress(self):
+        """Fold the oldest turns into the running summary without holding the lock during the LLM call"""
+        try:
+            # Repeat until turns added while summarising are also under the limit
+            while True:
+                with self.lock:
+                    count = self._excess_messages()
+                    if not count:
+                        self.compressing = False
+                        return
+                    old_turns = self.memory.chat_memory.messages[:count]
+                    summary = self.memory.moving_summary_buffer
+                
+                new_summary = self.memory.predict_new_summary(old_turns, summary)
+                with self.lock:
+                    # Only compress() removes messages, so the oldest `count` are still old_turns
+                    del self.memory.chat_memory.messages[:count]
+                    self.memory.moving_summary_buffer = new_summary
+        except Exception as e:
+            print(f"Error compressing conversation memory: {e}")
+            with self.lock:
+                self.compressing = False
+    
+    def _excess_messages(self) -> int:
+        """Number of oldest messages to drop to get under the token limit (lock held)"""
+        buffer = self.memory.chat_memory.messages
+        count = 0
+        while count < len(buffer) and \
+                self.memory.llm.get_num_tokens_from_messages(buffer[count:]) > self.memory.max_token_limit:
+            count += 1
+        return count
 
 class VotingAIAssistant:
     def __init__(self, openai_api_key: Optional[str] = None):
@@ -24,13 +347,19 @@ class VotingAIAssistant:
         """
         self.api_key = openai_api_key or os.getenv("OPENAI_API_KEY")
         self.llm = None
-        self.memory = ConversationBufferMemory()
+        # One conversation memory per client, dropped after an hour of inactivity
+        self.sessions = TTLCache(maxsize=1000, ttl=3600)
+        self._sessions_lock = threading.Lock()
         self.conversation_chain = None
         self.vector_store = None
+        self.batcher = None
         
         print(f"Initializing AI Assistant...")
         print(f"API Key available: {'Yes' if self.api_key else 'No'}")
         
+        # Initialize vector store with voting system knowledge
+        self._setup_knowledge_base()
+        
         if self.api_key:
             try:
                 self._initialize_langchain()
@@ -49,198 +378,286 @@ class VotingAIAssistant:
             self.llm = ChatOpenAI(
                 temperature=0.7,
                 model="gpt-4o-mini",
-                openai_api_key=self.api_key
+                streaming=True,
+                openai_api_key=self.api_key,
+                http_client=HTTP_CLIENT,
+                http_async_client=HTTP_ASYNC_CLIENT
             )
             
+            # Batch concurrent prompts into shared API calls
+            self.batcher = PromptBatcher(self.llm)
+            
             # Create conversation chain
             self.conversation_chain = ConversationChain(
                 llm=self.llm,
-                memory=self.memory,
                 verbose=False
             )
             
-            # Initialize vector store with voting system knowledge
-            self._setup_knowledge_base()
-            
         except Exception as e:
             print(f"Error initializing LangChain: {e}")
     
     def _setup_knowledge_base(self):
         """Setup knowledge base for voting system information"""
-        voting_knowledge = """
-        Online Voting System Features:
-        1. User Registration: Users can register with email, username, and password
-        2. Secure Authentication: Advanced encryption and secure login
-        3. Election Management: Admins can create and manage elections
-        4. Candidate Management: Add and manage election candidates
-        5. Real-time Voting: Live vote casting with immediate updates
-        6. Result Tracking: Real-time election results and statistics
-        7. Security Features: Encrypted votes, anonymous voting, audit trails
-        8. Admin Dashboard: Comprehensive admin interface for system management
-        
-        Voting Process:
-        1. User registers/logs in
-        2. Browse active elections
-        3. Select an election
-        4. View candidates and descriptions
-        5. Cast vote for preferred candidate
-        6. Confirm vote (cannot be changed)
-        7. View real-time results
-        
-        Security Measures:
-        - Advanced encryption for all votes
-        - Anonymous voting (no personal data linked to votes)
-        - Blockchain-like verification
-        - Audit trails for transparency
-        - No vote modification after submission
-        - Secure authentication and session management
-        
-        Common Questions:
-        - How to register: Click Register button, enter email and create password
-        - How to vote: Login, browse elections, select candidate, confirm vote
-        - Can I change my vote: No, votes cannot be modified after submission
-        - Is voting secure: Yes, uses advanced encryption and anonymous voting
-        - How long do elections last: Varies from 24 hours to 10 days
-        - Can I see results: Yes, real-time results are available on election pages
-        """
-        
         try:
-            # Split text into chunks
-            text_splitter = CharacterTextSplitter(
-                chunk_size=1000,
-                chunk_overlap=200
+            # Small local model, so the knowledge base needs no API key or network
+            # Normalized vectors make inner product equal to cosine similarity
+            embeddings = HuggingFaceEmbeddings(
+                model_name=EMBEDDING_MODEL,
+                encode_kwargs={"normalize_embeddings": True}
             )
-            texts = text_splitter.split_text(voting_knowledge)
             
-            # Create embeddings and vector store
-            embeddings = OpenAIEmbeddings(openai_api_key=self.api_key)
-            self.vector_store = Chroma.from_texts(
-                texts=texts,
+            # Reuse the index from a previous run if it was built from the same knowledge and model
+            fingerprint = _knowledge_fingerprint()
+            if os.path.exists(KNOWLEDGE_FINGERPRINT_FILE):
+                with open(KNOWLEDGE_FINGERPRINT_FILE) as f:
+                    saved_fingerprint = f.read().strip()
+                if saved_fingerprint == fingerprint:
+                    # The pickled docstore is one this method saved on an earlier start
+                    self.vector_store = FAISS.load_local(
+                        KNOWLEDGE_DIR,
+                        embeddings,
+                        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+                        allow_dangerous_deserialization=True
+                    )
+                    return
+            
+            # Create embeddings and an exact inner-product (IndexFlatIP) store
+            self.vector_store = FAISS.from_texts(
+                texts=KNOWLEDGE_SECTIONS,
                 embedding=embeddings,
-                collection_name="voting_system_knowledge"
+                distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
             )
+            self.vector_store.save_local(KNOWLEDGE_DIR)
+            with open(KNOWLEDGE_FINGERPRINT_FILE, "w") as f:
+                f.write(fingerprint)
         except Exception as e:
             print(f"Error setting up knowledge base: {e}")
     
-    def get_response(self, user_message: str, context: Optional[Dict] = None) -> str:
+    def get_response(self, user_message: str, context: Optional[Dict] = None,
+                     session_id: Optional[str] = None) -> str:
         """
         Get AI response for user message
         
         Args:
             user_message: User's input message
             context: Optional context (election data, user info, etc.)
+            session_id: Optional conversation key; without one no history is kept
         
         Returns:
             AI response string
         """
+        return self._respond(user_message, context, session_id)[0]
+    
+    def _respond(self, user_message: str, context: Optional[Dict] = None,
+                 session_id: Optional[str] = None) -> Tuple[str, bool]:
+        """Get AI response plus whether it came from the language model rather than the fallback"""
         if not self.llm:
-            return self._get_fallback_response(user_message)
+            return self._get_fallback_response(user_message), False
         
         try:
-            # Create system prompt with context
-            system_prompt = self._create_system_prompt(context)
-            
             # Get response from LangChain
-            messages = [
-                SystemMessage(content=system_prompt),
-                HumanMessage(content=user_message)
-            ]
-            
-            response = self.llm(messages)
-            return response.content
+            session = self._session(session_id)
+            knowledge = EMBEDDING_EXECUTOR.submit(self._retrieve_knowledge, user_message).result()
+            messages = self._build_messages(user_message, context, session, knowledge)
+            response = self.batcher.submit_sync(messages)
+            self._remember(session, user_message, response)
+            return response, True
             
         except Exception as e:
             print(f"Error getting AI response: {e}")
-            return self._get_fallback_response(user_message)
+            return self._get_fallback_response(user_message), False
     
-    def _create_system_prompt(self, context: Optional[Dict] = None) -> str:
-        """Create system prompt with context"""
-        base_prompt = """You are an AI Assistant for an Online Voting System called NeuroVote. Your role is to help users with:
-
-🎯 Voting Assistant: Help with registration, login, and vote-casting
-💬 FAQ Responder: Answer common questions about the voting process
-🧠 Interactive Help: Provide step-by-step guidance
-🛡️ Security Advisor: Explain security features and privacy
-📈 Election Summary: Provide election information and statistics
-🗣️ General Conversation: Be friendly and conversational, not just functional
-👨‍💼 Admin Support: Provide special assistance for administrators
-
-IMPORTANT GUIDELINES:
-- Be friendly, warm, and conversational - not just robotic
-- Use emojis and clear formatting to make responses engaging
-- If someone asks about non-voting topics, be helpful but gently guide them back to voting-related assistance
-- For admins, provide more detailed technical and administrative support
-- Keep responses concise but comprehensive
-- Always maintain a helpful and positive tone
-- If you don't understand something, ask for clarification or redirect to voting topics
-- Be patient and understanding with users"""
-
-        if context:
-            context_str = f"\n\nCurrent Context:\n"
-            for key, value in context.items():
-                context_str += f"- {key}: {value}\n"
-            base_prompt += context_str
+    async def aget_response(self, user_message: str, emit: Callable, sid: str,
+                            context: Optional[Dict] = None) -> str:
+        """
+        Stream AI response for user message token by token
+        
+        Args:
+            user_message: User's input message
+            emit: Socket.IO emit function used to push 'ai_token' events
+            sid: Session id of the client to stream to, also used as its conversation key
+            context: Optional context (election data, user info, etc.)
+        
+        Returns:
+            Full AI response string once generation has finished
+        """
+        if not self.llm:
+            response = self._get_fallback_response(user_message)
+            emit('ai_token', {'t': response}, to=sid)
+            return response
         
-        return base_prompt
+        stream_handler = AsyncStreamHandler(emit, sid)
+        cached_response = None
+        try:
+            session = self._session(sid)
+            
+            # Only a conversation's opening message is independent of history, so only it is cached
+            cache_key = None if session.history() else _response_cache_key(user_message, context)
+            cached_response = _get_cached_response(cache_key)
+            if cached_response is not None:
+                emit('ai_token', {'t': cached_response}, to=sid)
+                self._remember(session, user_message, cached_response)
+                return cached_response
+            
+            knowledge = await self._aretrieve_knowledge(user_message)
+            messages = self._build_messages(user_message, context, session, knowledge)
+            result = await asyncio.wait_for(
+                self._agenerate_throttled(messages, stream_handler),
+                self.batcher.timeout if self.batcher else None
+            )
+            response = result.generations[0][0].text
+            _cache_response(cache_key, response)
+            self._remember(session, user_message, response)
+            return response
+            
+        except Exception as e:
+            print(f"Error streaming AI response: {e}")
+            # The client already shows a cached or partial reply; don't append canned text to it
+            if cached_response is not None:
+                return cached_response
+            if stream_handler.tokens:
+                return "".join(stream_handler.tokens)
+            response = self._get_fallback_response(user_message)
+            emit('ai_token', {'t': response}, to=sid)
+            return response
     
-    def _get_fallback_response(self, user_message: str) -> str:
-        """Fallback responses when LangChain is not available"""
-        message = user_message.lower()
+    async def _agenerate_throttled(self, messages: List, stream_handler: AsyncStreamHandler):
+        """Stream one reply, sharing the batcher's rate limit so streams don't trigger 429s either"""
+        if self.batcher:
+            await self.batcher.limiter.acquire()
+        return await self.llm.agenerate(messages=[messages], callbacks=[stream_handler])
+    
+    def stream_response(self, user_message: str, emit: Callable, sid: str,
+                        context: Optional[Dict] = None) -> str:
+        """Run aget_response to completion from a regular (non-async) caller"""
+        coroutine = self.aget_response(user_message, emit, sid, context)
+        if not self.batcher:
+            return asyncio.run(coroutine)
         
-        # Voting Assistant responses
-        if any(word in message for word in ["register", "sign up", "create account"]):
-            return "To register: 1) Click 'Register' in top navigation 2) Enter email 3) Create username/password 4) Verify email 5) Start voting! Need help with any step?"
+        # Under gevent the batcher loop runs on this OS thread, so asyncio.run() would
+        # find a running loop; hand the coroutine to the batcher's loop instead. This also
+        # keeps the pooled async HTTP client on a single event loop
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.batcher.loop)
+        try:
+            # aget_response already times out generation; this only covers a stalled loop
+            return future.result(2 * self.batcher.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+    
+    def _session(self, session_id: Optional[str]) -> Optional[ConversationSession]:
+        """Conversation memory for a client, created on first use"""
+        if session_id is None:
+            return None
+        with self._sessions_lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self.sessions[session_id] = ConversationSession(self.llm)
+            return session
+    
+    def _retrieve_knowledge(self, user_message: str) -> str:
+        """Knowledge base sections closest to the message (blocking; embeds the query)"""
+        if not self.vector_store:
+            return ""
+        docs = self.vector_store.similarity_search(user_message, k=2)
+        return "\n\n".join(doc.page_content for doc in docs)
+    
+    async def _aretrieve_knowledge(self, user_message: str) -> str:
+        """_retrieve_knowledge on a native thread, so the event loop keeps serving other streams"""
+        loop = asyncio.get_running_loop()
+        if not monkey.is_module_patched('threading'):
+            return await loop.run_in_executor(None, self._retrieve_knowledge, user_message)
         
-        if any(word in message for word in ["vote", "cast vote", "election"]):
-            return "Voting Process: 1) Login 2) Browse active elections 3) Select election 4) View candidates 5) Click 'Vote for [Candidate]' 6) Confirm choice. Your vote is encrypted and secure!"
+        # gevent's futures aren't concurrent.futures.Future, so bridge the result to the loop by hand
+        future = loop.create_future()
+        EMBEDDING_EXECUTOR.submit(self._retrieve_knowledge, user_message).add_done_callback(
+            lambda done: loop.call_soon_threadsafe(_copy_result, done, future)
+        )
+        return await future
+    
+    def _build_messages(self, user_message: str, context: Optional[Dict] = None,
+                        session: Optional[ConversationSession] = None,
+                        knowledge: str = "") -> List:
+        """Build the message list sent to the language model"""
+        # Create system prompt with context
+        system_prompt = self._create_system_prompt(context)
         
-        if any(word in message for word in ["login", "sign in"]):
-            return "To login: 1) Click 'Login' 2) Enter username/email 3) Enter password 4) Click 'Login'. Forgot password? Contact support."
+        # Ground the reply in the most relevant knowledge base sections
+        if knowledge:
+            system_prompt += f"\n\nRelevant knowledge:\n{knowledge}"
         
-        # FAQ responses
-        if any(word in message for word in ["change vote", "modify vote"]):
-            return "Votes cannot be changed once submitted to maintain election integrity. Please review carefully before confirming."
+        history = session.history() if session else []
         
-        if any(word in message for word in ["how long", "duration", "time"]):
-            return "Election duration varies: Student Council (7-10 days), Department polls (3-5 days), Quick surveys (24-48 hours)."
+        return [
+            SystemMessage(content=system_prompt),
+            *history,
+            HumanMessage(content=user_message)
+        ]
+    
+    def _remember(self, session: Optional[ConversationSession], user_message: str, response: str):
+        """Store a conversation turn, compressing old turns off the reply path"""
+        if session and session.add_turn(user_message, response):
+            threading.Thread(target=session.compress, daemon=True).start()
+    
+    def _create_system_prompt(self, context: Optional[Dict] = None) -> str:
+        """Create system prompt with context"""
+        if not context:
+            return BASE_PROMPT
+        return BASE_PROMPT + _format_context(context)
+    
+    def _get_fallback_response(self, user_message: str) -> str:
+        """Fallback responses when LangChain is not available"""
+        message = user_message.lower()
         
-        # Security responses
-        if any(word in message for word in ["secure", "safe", "privacy", "encryption"]):
-            return "Security Features: 🔐 Advanced encryption, 🔒 Anonymous voting, 🛡️ Blockchain verification, 🔍 Audit trails, 🚫 No vote modification. Your vote is completely secure!"
+        # One pass over the message finds every keyword; the highest-priority group wins
+        rank = min((rank for _, rank in FALLBACK_KEYWORDS.iter(message)), default=None)
+        if rank is None:
+            return DEFAULT_FALLBACK_RESPONSE
+        return FALLBACK_RESPONSES[rank][1]
 
-         if any(word in message for word in ["secur", "saf", "privac", "encryption"]):
-            return "Security Features: 🔐 Advanced encryption, 🔒 Anonymous votiing
-            🛡️ Blockchain verification, 🔍 Audit trails, 🚫 No vote modification. Your vote is completely secure!"
-        # Help responses
-        if any(word in message for word in ["help", "support", "assist","hlp","Help",]):
-            return "I'm your AI voting assistant! I can help with: Registration, Voting process, Security, Election info, Technical support. What do you need help with?"
-        
-        # General greetings and casual conversation
-        if any(word in message for word in ["hello", "hi", "hey", "good morning", "good afternoon", "good evening", "how are you"]):
-            return "Hello! 👋 I'm your AI assistant for NeuroVote. How can I help you today? I can assist with voting, registration, or just chat about anything!"
+# Replies to recurring FAQ-style questions, keyed on normalized message and context
+_response_cache = TTLCache(maxsize=10000, ttl=3600)
+_response_cache_lock = threading.Lock()
 
-         if any(word in message for word in ["hello", "hi", "hey", "good morning", "good afternoon", "good evening", "how are you"]):
-            return "Hello! 👋 I'm your AI assistant for NeuroVote.How can in help you.
+# Context keys that make a reply specific to one user, so it is never cached
+USER_SPECIFIC_CONTEXT_KEYS = {"username", "user_id", "email"}
 
+def _response_cache_key(user_message: str, context: Optional[Dict] = None):
+    """Build the cache key for a message, or None if the reply should not be cached"""
+    context = context or {}
+    if USER_SPECIFIC_CONTEXT_KEYS & context.keys():
+        return None
+    key = (user_message.strip().lower(), tuple(sorted(context.items())))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
 
-        
-        # Thank you responses
-        if any(word in message for word in ["thank you", "thanks", "appreciate", "grateful"]):
-            return "You're very welcome! 😊 I'm happy to help. Is there anything else you'd like to know about voting or the system?"
-        
-        # Questions about the AI itself
-        if any(word in message for word in ["who are you", "what are you", "your name", "ai", "artificial intelligence", "bot"]):
-            return "I'm an AI assistant designed specifically for NeuroVote! 🤖 I help users with voting, registration, security questions, and general support. I'm here to make your voting experience smooth and enjoyable."
-        
-        # Default response - more conversational
-        return "That's interesting! 🤔 I'm primarily here to help with voting, but I'm happy to chat. Is there anything about the voting system you'd like to know, or do you have other questions?"
+def _get_cached_response(key) -> Optional[str]:
+    if key is None:
+        return None
+    with _response_cache_lock:
+        return _response_cache.get(key)
+
+def _cache_response(key, response: str):
+    if key is None:
+        return
+    with _response_cache_lock:
+        _response_cache[key] = response
 
 # Global instance
 ai_assistant = VotingAIAssistant()
 
 def get_ai_response(user_message: str, context: Optional[Dict] = None) -> str:
     """Global function to get AI response"""
-
-    return ai_assistant.get_response(user_message, context) 
-
-
+    key = _response_cache_key(user_message, context)
+    response = _get_cached_response(key)
+    if response is not None:
+        return response
+    
+    # Fallback replies after an API error are not cached, so an outage doesn't outlive itself
+    response, from_llm = ai_assistant._respond(user_message, context)
+    if from_llm:
+        _cache_response(key, response)
+    return response
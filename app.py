@@ -1,3 +1,7 @@
+# Patch the stdlib before anything else imports it so blocking I/O becomes cooperative
+from gevent import get_hub, monkey
+monkey.patch_all()
+
 from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
@@ -5,23 +9,49 @@ from flask_socketio import SocketIO, emit
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField, SelectField, TextAreaField
 from wtforms.validators import DataRequired, Email, Length, EqualTo
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from sqlalchemy import event, func, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 from datetime import datetime, timedelta
+import ipaddress
 import os
+import sqlite3
 import uuid
 import json
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-change-in-production')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///voting_system.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///voting_system.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    # e.g. postgresql+psycopg://..., which allows concurrent writers
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': 20, 'max_overflow': 40, 'pool_pre_ping': True}
 
 db = SQLAlchemy(app)
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='gevent')
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+password_hasher = PasswordHasher(time_cost=2, memory_cost=65536, parallelism=2)
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Use WAL so readers don't block the vote writer, and relax fsync to once per checkpoint"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA mmap_size=268435456')
+    cursor.execute('PRAGMA cache_size=-65536')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+
 # Database Models
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -45,11 +75,17 @@ class Election(db.Model):
     candidates = db.relationship('Candidate', backref='election', lazy=True, cascade='all, delete-orphan')
     votes = db.relationship('Vote', backref='election', lazy=True)
 
+    __table_args__ = (
+        # Serves the "currently active elections" range query
+        db.Index('ix_election_active_dates', 'is_active', 'start_date', 'end_date'),
+    )
+
 class Candidate(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text)
     election_id = db.Column(db.Integer, db.ForeignKey('election.id'), nullable=False)
+    vote_count = db.Column(db.Integer, default=0, nullable=False)
     votes_received = db.relationship('Vote', backref='candidate', lazy=True)
 
 class Vote(db.Model):
@@ -58,8 +94,14 @@ class Vote(db.Model):
     election_id = db.Column(db.Integer, db.ForeignKey('election.id'), nullable=False)
     candidate_id = db.Column(db.Integer, db.ForeignKey('candidate.id'), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
-    ip_address = db.Column(db.String(45))
-    session_id = db.Column(db.String(100))
+    ip_address = db.Column(db.LargeBinary(16))
+    session_id = db.Column(db.LargeBinary(16))
+
+    __table_args__ = (
+        # One ballot per voter per election, enforced by the database
+        db.Index('uq_vote_voter_election', 'voter_id', 'election_id', unique=True),
+        db.Index('ix_vote_candidate', 'candidate_id'),
+    )
 
 # Forms
 class LoginForm(FlaskForm):
@@ -86,6 +128,94 @@ class CandidateForm(FlaskForm):
     description = TextAreaField('Description')
     submit = SubmitField('Add Candidate')
 
+def hash_password(password):
+    """Hash a password with Argon2id on gevent's native threadpool so other greenlets keep running"""
+    return get_hub().threadpool.apply(password_hasher.hash, (password,))
+
+def argon2_matches(password_hash, password):
+    """Verify against an Argon2 hash, returning a bool instead of raising on a mismatch"""
+    try:
+        return password_hasher.verify(password_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+def verify_password(user, password):
+    """Check a user's password, upgrading legacy Werkzeug and outdated Argon2 hashes on success"""
+    threadpool = get_hub().threadpool
+    if not user.password_hash.startswith('$argon2'):
+        if not threadpool.apply(check_password_hash, (user.password_hash, password)):
+            return False
+    else:
+        # Errors raised inside the threadpool are logged as worker failures, so catch them there
+        if not threadpool.apply(argon2_matches, (user.password_hash, password)):
+            return False
+        if not password_hasher.check_needs_rehash(user.password_hash):
+            return True
+    
+    user.password_hash = hash_password(password)
+    db.session.commit()
+    return True
+
+def pack_ip_address(address):
+    """Pack an IPv4 or IPv6 address into 16 bytes, mapping IPv4 into IPv6 space"""
+    if not address:
+        return None
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return None
+    if ip.version == 4:
+        ip = ipaddress.IPv6Address(f'::ffff:{ip}')
+    return ip.packed
+
+def upgrade_schema():
+    """Add columns and indexes introduced after an existing database was created"""
+    candidate_columns = {column['name'] for column in inspect(db.engine).get_columns('candidate')}
+    if 'vote_count' not in candidate_columns:
+        with db.engine.begin() as conn:
+            conn.execute(text('ALTER TABLE candidate ADD COLUMN vote_count INTEGER NOT NULL DEFAULT 0'))
+            conn.execute(text('UPDATE candidate SET vote_count = '
+                              '(SELECT COUNT(*) FROM vote WHERE vote.candidate_id = candidate.id)'))
+    
+    # Votes used to store session_id and ip_address as text
+    if db.engine.dialect.name == 'sqlite':
+        with db.engine.begin() as conn:
+            rows = conn.execute(text("SELECT id, session_id, ip_address FROM vote "
+                                     "WHERE typeof(session_id) = 'text' OR typeof(ip_address) = 'text'")).all()
+            for vote_id, session_id, ip_address in rows:
+                if isinstance(session_id, str):
+                    session_id = uuid.UUID(session_id).bytes
+                if isinstance(ip_address, str):
+                    ip_address = pack_ip_address(ip_address)
+                conn.execute(text('UPDATE vote SET session_id = :session_id, ip_address = :ip_address WHERE id = :id'),
+                             {'session_id': session_id, 'ip_address': ip_address, 'id': vote_id})
+    
+    # Ballots cast before the unique index existed may hold duplicates it would reject
+    vote_indexes = {index['name'] for index in inspect(db.engine).get_indexes('vote')}
+    if 'uq_vote_voter_election' not in vote_indexes:
+        duplicates = db.session.query(Vote.voter_id, Vote.election_id, func.count(Vote.id)) \
+            .group_by(Vote.voter_id, Vote.election_id).having(func.count(Vote.id) > 1).all()
+        if duplicates:
+            details = ', '.join(f'voter {voter_id} in election {election_id} ({count} votes)'
+                                for voter_id, election_id, count in duplicates)
+            raise RuntimeError(f'Cannot create unique index uq_vote_voter_election, the vote table has '
+                               f'duplicate ballots: {details}. Delete the extra vote rows and correct '
+                               f'candidate.vote_count, then start the app again.')
+    
+    for table in db.metadata.tables.values():
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+def get_active_elections(now):
+    """Elections that are open for voting at the given time"""
+    return db.session.execute(
+        db.select(Election).where(
+            Election.is_active == True,
+            Election.start_date <= now,
+            Election.end_date >= now
+        )
+    ).scalars().all()
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -93,10 +223,7 @@ def load_user(user_id):
 # Routes
 @app.route('/')
 def index():
-    active_elections = Election.query.filter_by(is_active=True).filter(
-        Election.start_date <= datetime.utcnow(),
-        Election.end_date >= datetime.utcnow()
-    ).all()
+    active_elections = get_active_elections(datetime.utcnow())
     return render_template('index.html', elections=active_elections)
 
 @app.route('/register', methods=['GET', 'POST'])
@@ -106,7 +233,7 @@ def register():
     
     form = RegistrationForm()
     if form.validate_on_submit():
-        hashed_password = generate_password_hash(form.password.data)
+        hashed_password = hash_password(form.password.data)
         user = User(
             username=form.username.data,
             email=form.email.data,
@@ -127,7 +254,7 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
-        if user and check_password_hash(user.password_hash, form.password.data):
+        if user and verify_password(user, form.password.data):
             login_user(user)
             return redirect(url_for('index'))
         else:
@@ -144,23 +271,19 @@ def logout():
 @app.route('/progress')
 @login_required
 def progress():
-    # Get user's voting history
-    user_votes = Vote.query.filter_by(voter_id=current_user.id).all()
+    # Get user's voting history along with each vote's election
+    user_votes = Vote.query.options(joinedload(Vote.election)).filter_by(voter_id=current_user.id).all()
     
     # Get all elections the user has participated in with vote timestamps
-    participated_elections = []
-    election_vote_times = {}
+    first_votes = {}
     for vote in user_votes:
-        election = Election.query.get(vote.election_id)
-        if election and election not in participated_elections:
-            participated_elections.append(election)
-            election_vote_times[election.id] = vote.timestamp
+        if vote.election_id not in first_votes:
+            first_votes[vote.election_id] = vote
+    participated_elections = [vote.election for vote in first_votes.values()]
+    election_vote_times = {election_id: vote.timestamp for election_id, vote in first_votes.items()}
     
     # Get active elections
-    active_elections = Election.query.filter_by(is_active=True).filter(
-        Election.start_date <= datetime.utcnow(),
-        Election.end_date >= datetime.utcnow()
-    ).all()
+    active_elections = get_active_elections(datetime.utcnow())
     
     # Calculate statistics
     total_elections = Election.query.count()
@@ -187,14 +310,10 @@ def election_detail(election_id):
 @app.route('/vote/<int:election_id>/<int:candidate_id>', methods=['POST'])
 @login_required
 def vote(election_id, candidate_id):
-    # Check if user has already voted
-    existing_vote = Vote.query.filter_by(voter_id=current_user.id, election_id=election_id).first()
-    if existing_vote:
-        return jsonify({'success': False, 'message': 'You have already voted in this election'})
-    
     # Check if election is active
     election = Election.query.get_or_404(election_id)
-    if not election.is_active or datetime.utcnow() < election.start_date or datetime.utcnow() > election.end_date:
+    now = datetime.utcnow()
+    if not election.is_active or now < election.start_date or now > election.end_date:
         return jsonify({'success': False, 'message': 'Election is not active'})
     
     # Create vote
@@ -202,20 +321,38 @@ def vote(election_id, candidate_id):
         voter_id=current_user.id,
         election_id=election_id,
         candidate_id=candidate_id,
-        ip_address=request.remote_addr,
-        session_id=str(uuid.uuid4())
+        ip_address=pack_ip_address(request.remote_addr),
+        session_id=uuid.uuid4().bytes
     )
-    db.session.add(vote)
-    db.session.commit()
+    # A repeat ballot is rejected by the unique index rather than a prior lookup
+    try:
+        db.session.add(vote)
+        
+        # Keep the candidate's running total in the same transaction as the ballot
+        updated = Candidate.query.filter_by(id=candidate_id, election_id=election_id).update(
+            {Candidate.vote_count: Candidate.vote_count + 1}
+        )
+        if not updated:
+            db.session.rollback()
+            return jsonify({'success': False, 'message': 'Invalid candidate for this election'})
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': 'You have already voted in this election'})
     
-    # Emit real-time update
+    total_votes = db.session.query(func.sum(Candidate.vote_count)).filter_by(election_id=election_id).scalar()
+    
+    # Emit real-time update to clients watching this election, outside the request
+    socketio.start_background_task(broadcast_vote_update, election_id, candidate_id, total_votes)
+    
+    return jsonify({'success': True, 'message': 'Vote cast successfully!'})
+
+def broadcast_vote_update(election_id, candidate_id, total_votes):
     socketio.emit('vote_update', {
         'election_id': election_id,
         'candidate_id': candidate_id,
-        'total_votes': len(election.votes)
-    })
-    
-    return jsonify({'success': True, 'message': 'Vote cast successfully!'})
+        'total_votes': total_votes
+    }, to=f'election_{election_id}')
 
 @app.route('/admin')
 @login_required
@@ -230,7 +367,11 @@ def admin_dashboard():
     # Calculate total votes
     total_votes = Vote.query.count()
     
-    return render_template('admin_dashboard.html', elections=elections, users=users, total_votes=total_votes)
+    # Per-user vote counts in one query instead of loading every user's votes
+    user_vote_counts = dict(db.session.query(Vote.voter_id, func.count(Vote.id)).group_by(Vote.voter_id).all())
+    
+    return render_template('admin_dashboard.html', elections=elections, users=users, total_votes=total_votes,
+                           user_vote_counts=user_vote_counts)
 
 @app.route('/admin/election/create', methods=['GET', 'POST'])
 @login_required
@@ -292,11 +433,12 @@ def election_results(election_id):
         return redirect(url_for('index'))
     
     election = Election.query.get_or_404(election_id)
-    results = {}
     
-    for candidate in election.candidates:
-        vote_count = Vote.query.filter_by(candidate_id=candidate.id).count()
-        results[candidate.name] = vote_count
+    # Count votes for every candidate in one aggregated query
+    rows = db.session.query(Candidate.name, func.count(Vote.id)) \
+        .select_from(Candidate).outerjoin(Vote, Vote.candidate_id == Candidate.id) \
+        .filter(Candidate.election_id == election_id).group_by(Candidate.id).all()
+    results = dict(rows)
     
     total_votes = sum(results.values())
     return render_template('election_results.html', election=election, results=results, total_votes=total_votes)
@@ -304,12 +446,7 @@ def election_results(election_id):
 @app.route('/api/election/<int:election_id>/results')
 def api_election_results(election_id):
     election = Election.query.get_or_404(election_id)
-    results = {}
-    
-    for candidate in election.candidates:
-        vote_count = Vote.query.filter_by(candidate_id=candidate.id).count()
-        results[candidate.name] = vote_count
-    
+    results = {candidate.name: candidate.vote_count for candidate in election.candidates}
     return jsonify(results)
 
 # Socket.IO events
@@ -328,9 +465,38 @@ def handle_join_election(data):
     from flask_socketio import join_room
     join_room(f'election_{election_id}')
 
+# Built at startup in __main__; stays None when the LLM stack isn't installed
+ai_assistant = None
+
+@socketio.on('ai_stream')
+def handle_ai_stream(data):
+    if not isinstance(data, dict) or not isinstance(data.get('message'), str):
+        return
+    sid = request.sid
+    if ai_assistant is None:
+        response = "The AI assistant is not available right now."
+        socketio.emit('ai_token', {'t': response}, to=sid)
+        socketio.emit('ai_done', {'response': response}, to=sid)
+        return
+    message = data['message']
+    context = None
+    if current_user.is_authenticated:
+        context = {
+            'username': current_user.username,
+            'role': 'admin' if current_user.is_admin else 'voter'
+        }
+
+    def stream_response():
+        # Tokens are pushed to the client as 'ai_token' events while generating
+        response = ai_assistant.stream_response(message, socketio.emit, sid, context)
+        socketio.emit('ai_done', {'response': response}, to=sid)
+
+    socketio.start_background_task(stream_response)
+
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+        upgrade_schema()
         
         # Create admin user if none exists
         admin = User.query.filter_by(is_admin=True).first()
@@ -338,7 +504,7 @@ if __name__ == '__main__':
             admin = User(
                 username='admin',
                 email='admin@votingsystem.com',
-                password_hash=generate_password_hash('admin123'),
+                password_hash=hash_password('admin123'),
                 is_admin=True,
                 is_verified=True
             )
@@ -346,4 +512,11 @@ if __name__ == '__main__':
             db.session.commit()
             print("Admin user created: username='admin', password='admin123'")
     
+    # Load the embedding model and index before serving; doing it on the first chat
+    # message would block every greenlet while it runs
+    try:
+        from ai_assistant import ai_assistant
+    except ImportError as e:
+        print(f"AI assistant disabled, missing dependency: {e}")
+    
     socketio.run(app, debug=True, host='0.0.0.0', port=5000) 
\ No newline at end of file